@@ -6,12 +6,14 @@ https://sens-usa.com/hubfs/SENS%20Custom%20Blog%20-%202024/Images/101324_MicroGe
 Uses the contributed Solar.py example as a base for implementation.
 
 """
+import argparse
 import asyncio
 from asyncio import Queue
+from dataclasses import dataclass
 import logging
-from enum import Enum
-from math import log10
-from time import sleep
+from math import ceil, log10
+import os
+import struct
 
 from pymodbus import pymodbus_apply_logging_config
 
@@ -24,9 +26,6 @@ from pymodbus.pdu import ExceptionResponse
 from pymodbus import FramerType
 
 
-pymodbus_apply_logging_config(logging.ERROR)
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s %(message)s')
 _logger = logging.getLogger(__file__)
 
 SENS_MG2_MB_REGISTER_MAP = [
@@ -37,14 +36,7 @@ SENS_MG2_MB_REGISTER_MAP = [
     (8, "i", 1,     "Serial Number",                     "(Num)"),
     (10, "H", 1,     "Build Date (year)",                "(Num)"),
     (11, "H", 1,     "Build Date (month and day)",       "(Num)"),
-    (12, "I", 1,     "Model Number Characters 1-4",      "(Bit)"),
-    (14, "I", 1,     "Model Number Characters 5-8",      "(Bit)"),
-    (16, "I", 1,     "Model Number Characters 9-12",     "(Bit)"),
-    (18, "I", 1,     "Model Number Characters 13-16",    "(Bit)"),
-    (20, "I", 1,     "Model Number Characters 17-20",    "(Bit)"),
-    (22, "I", 1,     "Model Number Characters 21-24",    "(Bit)"),
-    (24, "I", 1,     "Model Number Characters 25-28",    "(Bit)"),
-    (26, "I", 1,     "Model Number Characters 29-32",    "(Bit)"),
+    (12, "32s", 1,   "Model Number",                     "(Str)"),
     (28, "I", 1,     "Holding Registers 28-29",          "(Num)"),
     (30, "I", 1,     "Holding Registers 30-31",          "(Num)"),
     (32, "I", 1,     "Holding Registers 32-33",          "(Num)"),
@@ -134,10 +126,91 @@ SENS_MG2_MB_REGISTER_MAP = [
     (200, "I", 1,     "Holding Register 200-201",         "(Num)"),
 ]
 
-# Define the client parameters here
-PORT = "COM1"
 
-COUNT = 102
+def check_register_map(register_map: list) -> None:
+    """Raise ValueError on a malformed or overlapping row, so a bad map fails at import and not mid-scan."""
+    for entry in register_map:
+        if not (isinstance(entry, tuple) and len(entry) == 5):
+            raise ValueError(f"Malformed register map row: {entry!r}")
+    end = 0
+    for addr, format, _, comment, _ in sorted(register_map):
+        if addr < end:
+            raise ValueError(f"{comment} at register {addr} overlaps the previous row")
+        end = addr + struct.calcsize(">" + format) // 2
+
+
+# Before anything below indexes into the rows
+check_register_map(SENS_MG2_MB_REGISTER_MAP)
+
+# Define the client parameters here, or override them through the environment / command line
+PORT = os.environ.get("SENS_PORT", "COM1")
+BAUDRATE = int(os.environ.get("SENS_BAUDRATE", "9600"))
+# Start bit, 8 data bits, parity and stop bit
+BITS_PER_CHAR = 11
+# Slack on top of the wire time of a request/response pair for the charger to answer (seconds)
+TIMEOUT_MARGIN = 0.05
+
+# Number of scans before the program ends
+CYCLES = int(os.environ.get("SENS_CYCLES", "4"))
+# Time from the start of one scan to the start of the next (seconds)
+SCAN_INTERVAL = float(os.environ.get("SENS_SCAN", "10"))
+
+# Rows named "Holding Register(s) XX-YY" are reserved in the manual and carry no information
+ACTIVE_MAP = [entry for entry in SENS_MG2_MB_REGISTER_MAP if not entry[3].startswith("Holding Register")]
+
+# The identity registers below this address (serial numbers, revisions, build date, model number)
+# cannot change while the charger is running, so they are read once at startup instead of every scan
+STATIC_END = 28
+
+# Values of the read-once registers, by name; retried on every scan until all of them were read
+DEVICE_INFO = {}
+
+# Last value logged per register name, so unchanged values are only logged at DEBUG
+_LAST_VALUE = {}
+
+# Format character -> ModbusClientMixin.DATATYPE name, only used to label the logged values
+_DTYPE_NAMES = {data_type.value[0]: data_type.name for data_type in AsyncModbusSerialClient.DATATYPE}
+
+
+@dataclass(slots=True)
+class Decoder:
+    """How to scale and label one register map entry out of a read group."""
+    is_string: bool
+    var_type: str
+    inv_factor: float | None  # None when the factor is 1 and the value is used as read
+    decimals: int
+    comment: str
+    unit: str
+
+
+@dataclass(slots=True)
+class ReadGroup:
+    """One multi-register read and the decoders for the values it contains."""
+    start: int
+    count: int
+    decoders: tuple[Decoder, ...]
+    layout: struct.Struct  # the whole block as big-endian 16-bit words
+    fields: struct.Struct  # the values of all decoders in one go, with pad bytes over the holes
+    buffer: bytearray  # reused on every scan to hold the packed registers
+
+
+# Decimal places kept after scaling, per factor: enough digits to resolve one raw count
+_DECIMALS = {factor: ceil(log10(factor)) for factor in {entry[2] for entry in SENS_MG2_MB_REGISTER_MAP}}
+
+# Modbus allows at most 125 holding registers in a single read
+MAX_READ_COUNT = 125
+# Largest hole (in registers) between two map entries that still gets read in one request
+MAX_READ_GAP = 8
+
+# A failed read is retried this many times, the connection is only reopened after that
+MAX_RETRIES = 3
+# Delay before the first retry, doubled on every further one up to MAX_BACKOFF (seconds)
+RETRY_BACKOFF = 0.05
+MAX_BACKOFF = 1.0
+# How long to wait for the client to come back up after a reconnect (seconds)
+RECONNECT_TIMEOUT = 2.0
+# Pause after (re)connecting, for devices that need time before the first request (seconds)
+RECONNECT_GRACE = 0.0
 
 async def main() -> None:
     """Run client setup."""
@@ -145,73 +218,230 @@ async def main() -> None:
     client: AsyncModbusSerialClient = AsyncModbusSerialClient(
         port=PORT,
         # Common optional parameters:
-        framer=FramerType.SOCKET,
-        timeout=5,
+        framer=FramerType.RTU,
+        baudrate=BAUDRATE,
+        # Sized for the largest read, so a lost reply is noticed quickly instead of after seconds
+        timeout=frame_timeout(max(group.count for group in STATIC_PLAN + SCAN_PLAN)),
+        # read_group does its own retrying with backoff, see MAX_RETRIES
+        retries=0,
     )
     await client.connect()
+    tune_serial_port(client)
     _logger.info("### Client connected")
-    sleep(1)
+    if RECONNECT_GRACE:
+        await asyncio.sleep(RECONNECT_GRACE)
     _logger.info("### Client starting")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
     for count in range(CYCLES):
-        _logger.info(f"Running loop {count}")
-        microgenius2_calls(client)
-        sleep(10)  # scan interval
+        _logger.info("Running loop %d", count)
+        await read_device_info(client)
+        await microgenius2_calls(client, SCAN_PLAN)
+        # Scans start on a fixed SCAN_INTERVAL grid, however long each one took
+        deadline += SCAN_INTERVAL
+        delay = deadline - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            deadline = loop.time()  # overran the interval, restart the grid instead of scanning back to back
     client.close()
     _logger.info("### End of Program")
 
 
-def microgenius2_calls(client: AsyncModbusSerialClient) -> None:
-    """Read registers."""
-    error = False
+async def read_device_info(client: AsyncModbusSerialClient) -> None:
+    """Read the identity groups still missing from DEVICE_INFO, and log the identity once it is complete."""
+    missing = [group for group in STATIC_PLAN if any(d.comment not in DEVICE_INFO for d in group.decoders)]
+    if not missing:
+        return
+    DEVICE_INFO.update(await microgenius2_calls(client, missing))
+    if all(d.comment in DEVICE_INFO for group in missing for d in group.decoders):
+        _logger.info("### Charger %s, serial number %s, program revision %s",
+                     DEVICE_INFO["Model Number"], DEVICE_INFO["System Serial Number"], DEVICE_INFO["Program Revision"])
+
+
+async def microgenius2_calls(client: AsyncModbusSerialClient, plan: list[ReadGroup]) -> dict:
+    """Read the registers of the plan and return the decoded values by name."""
+    # This loop is I/O bound, not compute bound. At 9600 baud every byte on the wire costs about 1.1 ms,
+    # while decoding a whole scan is well under a millisecond of Python. Reading the map one entry at a
+    # time took 102 round trips, about 1700 bytes or 2 s of wire time plus the charger's turnaround per
+    # request; SCAN_PLAN needs 3 reads and under 300 bytes, about 0.3 s. Further gains come from moving
+    # fewer frames and bytes (batching, reading static registers once), not from CPU-side tuning.
+    values = {}
+    # Only read_groups talks to the bus, so the previous group gets decoded while the next one is on the wire.
+    # maxsize=1 keeps the reader at most one response ahead of the decoder.
+    queue: Queue = Queue(maxsize=1)
+    await asyncio.gather(read_groups(client, queue, plan), decode_groups(queue, values))
+    return values
+
+
+async def read_groups(client: AsyncModbusSerialClient, queue: Queue, plan: list[ReadGroup]) -> None:
+    """Read every group and hand the responses to decode_groups, None marks the end of the scan."""
+    # One request per read group instead of one per register, see build_scan_plan
+    for group in plan:
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info("*** Reading registers %d-%d (%d values)",
+                         group.start, group.start + group.count - 1, len(group.decoders))
+
+        rr = await read_group(client, group.start, group.count)
+        if rr is None:
+            continue
+
+        await queue.put((group, rr))
+    await queue.put(None)
 
-    # Contains the Modbus Register Map for all of the Official Registers, i.e. Registers in the Manual
-    # Some of the Register names combine the name with the description, since the names are sometime vague
-    for addr, format, factor, comment, unit in ( # data_type according to ModbusClientMixin.DATATYPE.value[0]
 
-        if error:
-            error = False
-            client.close()
-            sleep(0.1)
-            client.connect()
-            sleep(1)
+async def decode_groups(queue: Queue, values: dict) -> None:
+    """Decode the responses produced by read_groups into values until the end of the scan."""
+    while (item := await queue.get()) is not None:
+        group, rr = item
+        process_registers(rr.registers, group, values)
 
-        data_type = get_data_type(format)
-        count = data_type.value[1]
-        var_type = data_type.name
 
-        _logger.info(f"*** Reading {comment} ({var_type})")
+async def read_group(client: AsyncModbusSerialClient, start: int, span: int):
+    """Read one group, retrying with exponential backoff before falling back to a reconnect.
 
+    Only transport failures are retried. An error response means the charger answered,
+    so the link is healthy and the group is just skipped for this scan.
+    """
+    for consecutive_errors in range(MAX_RETRIES + 1):
+        if consecutive_errors:
+            await asyncio.sleep(min(RETRY_BACKOFF * 2 ** consecutive_errors, MAX_BACKOFF))
         try:
-            rr = client.read_holding_registers(address=addr, count=count, slave=1)
+            rr = await client.read_holding_registers(address=start, count=span, slave=1)
         except ModbusException as exc:
-            _logger.error(f"Modbus exception: {exc!s}")
-            error = True
-            continue
-        if rr.isError():
-            _logger.error(f"Error")
-            error = True
+            _logger.error("Modbus exception: %s", exc)
             continue
         if isinstance(rr, ExceptionResponse):
-            _logger.error(f"Response exception: {rr!s}")
-            error = True
-            continue
+            _logger.error("Response exception: %s", rr)
+            return None
+        if rr.isError():
+            _logger.error("Error reading registers %d-%d: %s", start, start + span - 1, rr)
+            return None
+        if len(rr.registers) != span:
+            # The group is decoded with a fixed layout, a short or long reply cannot be unpacked
+            _logger.error("Expected %d registers from %d, got %d", span, start, len(rr.registers))
+            return None
+        return rr
+
+    await reconnect(client)
+    return None
+
+
+async def reconnect(client: AsyncModbusSerialClient) -> None:
+    """Reopen the connection and wait until the client reports it is up."""
+    client.close()
+    await client.connect()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RECONNECT_TIMEOUT
+    while not client.connected and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    tune_serial_port(client)
+    if RECONNECT_GRACE:
+        await asyncio.sleep(RECONNECT_GRACE)
+
+
+def tune_serial_port(client: AsyncModbusSerialClient) -> None:
+    """Put the serial port in low latency mode where the driver supports it.
 
+    USB RS485 adapters hold received bytes for up to 16 ms before passing them on,
+    which adds to every read; low latency mode hands them over right away.
+    pyserial only implements this on Linux, elsewhere the port is left as it is.
+    """
+    transport = getattr(getattr(client, "ctx", None), "transport", None)
+    port = getattr(transport, "sync_serial", None)
+    try:
+        port.set_low_latency_mode(True)
+    except (AttributeError, ValueError, OSError) as exc:
+        _logger.debug("Serial low latency mode not available: %s", exc)
 
-def process_registers():
-     value = client.convert_from_registers(rr.registers, data_type) / factor
-        if factor < 1:
-            value = round(value, int(log10(factor) * -1))
-        _logger.info(f"*** READ *** {comment} = {value} {unit}")
 
+def process_registers(registers: list, group: ReadGroup, values: dict) -> None:
+    """Decode and log the values of one read group, storing them in values by name."""
+    group.layout.pack_into(group.buffer, 0, *registers)
+    raw = group.fields.unpack(group.buffer)
+    for d, value in zip(group.decoders, raw):
+        if d.is_string:
+            value = decode_string(value)
+        elif d.inv_factor is not None:
+            value = round(value * d.inv_factor, d.decimals) if d.decimals else value * d.inv_factor
+        values[d.comment] = value
+        if _LAST_VALUE.get(d.comment) != value:
+            _LAST_VALUE[d.comment] = value
+            _logger.info("*** READ *** %s (%s) = %s %s", d.comment, d.var_type, value, d.unit)
+        else:
+            _logger.debug("*** READ *** %s unchanged", d.comment)
 
-def get_alarm_values(alarm_register: uint)
 
-def get_data_type(format: str) -> Enum:
-    """Return the ModbusTcpClient.DATATYPE according to the format"""
-    for data_type in ModbusSerialClient.DATATYPE:
-        if data_type.value[0] == format:
-            return data_type
+def decode_string(raw: bytes) -> str:
+    """Decode ASCII characters packed two per register, high byte first."""
+    return raw.decode("ascii", "replace").rstrip("\x00")
+
+
+def frame_timeout(count: int) -> float:
+    """Return how long a read of count registers takes on the wire, plus TIMEOUT_MARGIN."""
+    request_bytes = 8  # slave, function, address, count, CRC
+    response_bytes = 5 + 2 * count  # slave, function, byte count, data, CRC
+    return (request_bytes + response_bytes) * BITS_PER_CHAR / BAUDRATE + TIMEOUT_MARGIN
+
+
+def build_scan_plan(register_map: list) -> list[ReadGroup]:
+    """Merge the register map into as few multi-register reads as possible.
+
+    Entries are merged while the hole to the next address is at most MAX_READ_GAP
+    and the whole read stays within MAX_READ_COUNT registers.
+    The map formats are plain struct codes ("I", "i", "H", "32s"), so every group
+    gets a single big-endian Struct decoding all of its values at once.
+    """
+    plan = []
+    decoders = []
+    fields = []
+    start = end = 0
+    for addr, format, factor, comment, unit in sorted(register_map, key=lambda entry: entry[0]):
+        words = struct.calcsize(">" + format) // 2
+        if decoders and (addr - end > MAX_READ_GAP or addr + words - start > MAX_READ_COUNT):
+            plan.append(make_read_group(start, end, decoders, fields))
+            decoders = []
+            fields = []
+        if not decoders:
+            start = end = addr
+        if addr > end:
+            fields.append(f"{(addr - end) * 2}x")
+        fields.append(format)
+        end = addr + words
+        decoders.append(Decoder(format.endswith("s"), _DTYPE_NAMES[format[-1]],
+                                None if factor == 1 else 1.0 / factor, _DECIMALS[factor], comment, unit))
+    if decoders:
+        plan.append(make_read_group(start, end, decoders, fields))
+    return plan
+
+
+def make_read_group(start: int, end: int, decoders: list, fields: list) -> ReadGroup:
+    """Return the ReadGroup for the registers start to end (exclusive)."""
+    return ReadGroup(start, end - start, tuple(decoders),
+                     struct.Struct(f">{end - start}H"), struct.Struct(">" + "".join(fields)),
+                     bytearray(2 * (end - start)))
+
+
+
+STATIC_PLAN = build_scan_plan([entry for entry in ACTIVE_MAP if entry[0] < STATIC_END])
+SCAN_PLAN = build_scan_plan([entry for entry in ACTIVE_MAP if entry[0] >= STATIC_END])
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Read the registers of a SENS MicroGenius 2 battery charger.")
+    parser.add_argument("--port", default=PORT, help="serial port of the RS485 adapter (default: %(default)s)")
+    parser.add_argument("--baudrate", type=int, default=BAUDRATE, help="serial baud rate (default: %(default)s)")
+    parser.add_argument("--cycles", type=int, default=CYCLES, help="number of scans to run (default: %(default)s)")
+    parser.add_argument("--scan-interval", type=float, default=SCAN_INTERVAL,
+                        help="seconds from the start of one scan to the next (default: %(default)s)")
+    parser.add_argument("--debug", action="store_true", help="log debug output, including the raw pymodbus frames")
+    args = parser.parse_args()
+    PORT, BAUDRATE, CYCLES, SCAN_INTERVAL = args.port, args.baudrate, args.cycles, args.scan_interval
+
+    # Logging is only configured when run as a script, importing the module leaves it alone
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    # pymodbus logs through its own handler; its frame-level DEBUG records are only wanted with --debug
+    logging.getLogger("pymodbus").propagate = False
+    pymodbus_apply_logging_config(logging.DEBUG if args.debug else logging.WARNING)
+    asyncio.run(main())